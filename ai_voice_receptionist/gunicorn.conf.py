@@ -0,0 +1,29 @@
+"""
+Gunicorn Configuration
+Production server settings for the AI Voice Receptionist
+"""
+import os
+import threading
+
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '5000')}"
+
+# Every request spends nearly all of its time waiting on OpenAI, so a threaded
+# worker multiplexes many in-flight calls without extra processes. Conversation
+# state lives in-process, so scale threads before workers. Each /ws/call
+# connection holds one thread for the length of the call.
+worker_class = 'gthread'
+workers = int(os.getenv('GUNICORN_WORKERS', '1'))
+threads = int(os.getenv('GUNICORN_THREADS', '32'))
+
+# Streamed voice replies can take several seconds end to end
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.getenv('LOG_LEVEL', 'info').lower()
+
+def post_worker_init(worker):
+    """Warm up each worker in the background so it can serve requests immediately"""
+    from src.main import warm_up
+    threading.Thread(target=warm_up, name='openai-warmup', daemon=True).start()
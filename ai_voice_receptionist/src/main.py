@@ -1,5 +1,6 @@
 import os
 import sys
+import threading
 # DON'T CHANGE THIS !!!
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
@@ -9,11 +10,13 @@ load_dotenv()
 
 from flask import Flask, send_from_directory
 from flask_cors import CORS
+from sqlalchemy.engine import make_url
 from src.models.user import db
 from src.models.call import Call, Appointment, BusinessConfig
 from src.routes.user import user_bp
-from src.routes.voice_api import voice_bp
+from src.routes.voice_api import voice_bp, warm_up_services
 from src.routes.phone_api import phone_bp
+from src.services.openai_client import warm_up_openai
 
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
 app.config['SECRET_KEY'] = 'asdf#FGSgvasgf$5$WGT'
@@ -21,9 +24,43 @@ app.config['SECRET_KEY'] = 'asdf#FGSgvasgf$5$WGT'
 # Enable CORS for all routes
 CORS(app)
 
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def resolve_database_url(database_url):
+    """
+    Make relative SQLite paths relative to the project directory
+    
+    Flask-SQLAlchemy would otherwise resolve them against the instance folder.
+    
+    Args:
+        database_url (str): Database URL from the environment
+        
+    Returns:
+        str: Database URL with an absolute SQLite path
+    """
+    url = make_url(database_url)
+    if url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:') \
+            and not url.database.startswith('file:') and not os.path.isabs(url.database):
+        url = url.set(database=os.path.join(PROJECT_DIR, url.database))
+    return url.render_as_string(hide_password=False)
+
 # Database configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(os.path.dirname(__file__), 'database', 'app.db')}"
+database_url = resolve_database_url(
+    os.getenv('DATABASE_URL', f"sqlite:///{os.path.join(os.path.dirname(__file__), 'database', 'app.db')}")
+)
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# Connection pool sized for the threaded workers; recycle connections before
+# server-side idle timeouts (e.g. MySQL wait_timeout) drop them
+engine_options = {'pool_pre_ping': True}
+if not database_url.startswith('sqlite'):
+    engine_options.update({
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '10')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '20')),
+        'pool_recycle': 1800
+    })
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
 db.init_app(app)
 
 # Register blueprints
@@ -57,6 +94,12 @@ with app.app_context():
         
         db.session.commit()
 
+def warm_up():
+    """Create the voice services and prime the OpenAI connection pool (run by each server process)"""
+    with app.app_context():
+        warm_up_services()
+        warm_up_openai()
+
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def serve(path):
@@ -75,4 +118,5 @@ def serve(path):
 
 
 if __name__ == '__main__':
+    threading.Thread(target=warm_up, name='openai-warmup', daemon=True).start()
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -145,6 +145,9 @@ class BusinessConfig(db.Model):
     value = db.Column(db.Text, nullable=False)
     description = db.Column(db.Text, nullable=True)
     
+    # Bumped on every change made through set_config so cached context can be invalidated
+    version = 0
+    
     # Metadata
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -181,5 +184,6 @@ class BusinessConfig(db.Model):
             config = BusinessConfig(key=key, value=value, description=description)
             db.session.add(config)
         db.session.commit()
+        BusinessConfig.version += 1
         return config
 
@@ -4,7 +4,9 @@ import asyncio
 import json
 import base64
 import logging
+import math
 from datetime import datetime
+from sqlalchemy import select, func
 from ..services.twilio_service import TwilioService
 from ..services.realtime_voice_service import RealtimeVoiceService
 from ..services.speech_service import SpeechService
@@ -19,6 +21,14 @@ phone_bp = Blueprint('phone', __name__)
 twilio_service = TwilioService()
 active_calls = {}  # Store active call sessions
 
+# Columns returned by the call list; the conversation history is only loaded for call details
+CALL_LIST_COLUMNS = (
+    Call.id, Call.session_id, Call.caller_phone, Call.caller_name, Call.caller_email,
+    Call.start_time, Call.end_time, Call.duration_seconds, Call.call_status,
+    Call.primary_intent, Call.conversation_summary, Call.appointment_booked,
+    Call.lead_qualified, Call.follow_up_required, Call.created_at, Call.updated_at
+)
+
 @phone_bp.route('/webhook/voice', methods=['POST'])
 @cross_origin()
 def handle_incoming_call():
@@ -195,23 +205,35 @@ async def send_audio_to_twilio(ws, audio_data):
 def get_calls():
     """Get call history"""
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 50, type=int)
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = max(request.args.get('per_page', 50, type=int), 1)
         status = request.args.get('status')
         
-        query = Call.query
+        query = select(*CALL_LIST_COLUMNS)
+        count_query = select(func.count()).select_from(Call)
         
         if status:
-            query = query.filter(Call.status == status)
-        
-        calls = query.order_by(Call.start_time.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+            query = query.where(Call.call_status == status)
+            count_query = count_query.where(Call.call_status == status)
+        
+        # Fetch plain rows rather than hydrating ORM objects
+        rows = db.session.execute(
+            query.order_by(Call.start_time.desc())
+            .offset((page - 1) * per_page)
+            .limit(per_page)
+        ).all()
+        total = db.session.scalar(count_query)
+        
+        calls = [
+            {key: value.isoformat() if isinstance(value, datetime) else value
+             for key, value in row._mapping.items()}
+            for row in rows
+        ]
         
         return jsonify({
-            'calls': [call.to_dict() for call in calls.items],
-            'total': calls.total,
-            'pages': calls.pages,
+            'calls': calls,
+            'total': total,
+            'pages': math.ceil(total / per_page),
             'current_page': page
         })
         
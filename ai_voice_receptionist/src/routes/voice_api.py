@@ -2,34 +2,88 @@
 Voice API Routes
 Handles voice-related API endpoints for the AI receptionist
 """
-import os
 import io
-import tempfile
-from flask import Blueprint, request, jsonify, send_file
+import json
+import os
+import threading
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from flask import Blueprint, request, jsonify, Response, stream_with_context, current_app
+from flask_sock import Sock
 from werkzeug.utils import secure_filename
-from src.services.speech_service import SpeechService
-from src.services.dialogue_service import DialogueService
+from src.services.speech_service import SpeechService, start_stream
+from src.services.dialogue_service import DialogueService, APPOINTMENT_INTENT, warm_up_tokenizer
+from src.services.job_service import JobStore
+from src.services.calendar_service import parse_date, parse_time
 from src.models.call import Call, Appointment, BusinessConfig, db
+from sqlalchemy import select
 from datetime import datetime
 
 voice_bp = Blueprint('voice', __name__)
+sock = Sock()
 
 # Initialize services lazily
 speech_service = None
 dialogue_service = None
+_services_lock = threading.Lock()
+
+# Runs speech-to-text off the request thread so database work can overlap it.
+# One worker per request thread, so a transcription never queues behind another.
+stt_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('GUNICORN_THREADS', '32')),
+    thread_name_prefix='stt'
+)
+
+# Background process-call jobs, collected through /result/<job_id>
+call_jobs = JobStore()
+MAX_RESULT_WAIT_SECONDS = 30
+
+# Calls stay on the structured path while an appointment is being scheduled
+APPOINTMENT_FLOW_INTENTS = ('appointment_scheduling', 'appointment_booking')
+
+# Details required to book, and how to ask the caller for them
+APPOINTMENT_DETAILS = (
+    ('customer_name', 'your name'),
+    ('service_type', 'the service you need'),
+    ('date', 'the date'),
+    ('time', 'the time')
+)
+BOOKING_FAILED_REPLY = "I'm sorry, I wasn't able to book that appointment. Could you confirm the date and time you'd like?"
+
+# What a turn needs from its call, read before the read transaction ends
+CallTurn = namedtuple('CallTurn', ['call_id', 'primary_intent', 'appointment_booked'])
+
+class AudioNotUnderstoodError(Exception):
+    """Raised by a background call job whose audio could not be transcribed"""
 
 def get_speech_service():
     global speech_service
     if speech_service is None:
-        speech_service = SpeechService()
+        with _services_lock:
+            if speech_service is None:
+                service = SpeechService()
+                service._ensure_client_initialized()
+                speech_service = service
     return speech_service
 
 def get_dialogue_service():
     global dialogue_service
     if dialogue_service is None:
-        dialogue_service = DialogueService()
+        with _services_lock:
+            if dialogue_service is None:
+                service = DialogueService()
+                service._ensure_client_initialized()
+                dialogue_service = service
     return dialogue_service
 
+def warm_up_services():
+    """Create the voice services ahead of the first request (requires an app context)"""
+    get_speech_service()
+    get_dialogue_service()
+    warm_up_tokenizer()
+
 @voice_bp.route('/process-call', methods=['POST'])
 def process_call():
     """
@@ -47,64 +101,393 @@ def process_call():
         # Get caller information
         caller_phone = request.form.get('caller_phone', 'Unknown')
         call_id = request.form.get('call_id')
+        session_id = request.form.get('session_id')
         
-        # Save the uploaded audio file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as temp_file:
-            audio_file.save(temp_file.name)
-            
-            try:
-                # Convert speech to text
-                user_text = get_speech_service().speech_to_text(temp_file.name)
-                
-                if not user_text:
-                    return jsonify({'error': 'Could not process audio'}), 400
-                
-                # Get or create call record
-                if call_id:
-                    call = Call.query.get(call_id)
-                    if not call:
-                        call = Call(
-                            caller_phone=caller_phone,
-                            status='in_progress',
-                            start_time=datetime.utcnow()
-                        )
-                        db.session.add(call)
-                        db.session.commit()
-                else:
-                    call = Call(
-                        caller_phone=caller_phone,
-                        status='in_progress',
-                        start_time=datetime.utcnow()
-                    )
-                    db.session.add(call)
-                    db.session.commit()
-                
-                # Process the dialogue
-                response_text = get_dialogue_service().process_message(user_text, call.id)
-                
-                # Convert response to speech
-                audio_response = get_speech_service().text_to_speech(response_text)
-                
-                # Update call record
-                call.transcript = (call.transcript or '') + f"\nUser: {user_text}\nAssistant: {response_text}"
-                db.session.commit()
-                
-                # Return audio response
-                return send_file(
-                    io.BytesIO(audio_response),
-                    mimetype='audio/wav',
-                    as_attachment=True,
-                    download_name='response.wav'
+        speech = get_speech_service()
+        app = current_app._get_current_object()
+        
+        def transcribe():
+            with app.app_context():
+                return speech.speech_to_text(
+                    audio_file.stream, audio_file.filename, audio_file.mimetype or 'audio/wav'
                 )
-                
-            finally:
-                # Clean up temporary file
-                if os.path.exists(temp_file.name):
-                    os.unlink(temp_file.name)
+        
+        # Convert speech to text straight from the upload stream while an
+        # existing call record and its conversation context are loaded
+        stt_future = stt_executor.submit(transcribe)
+        call = _find_call(call_id, session_id)
+        if call:
+            turn = _begin_turn(call)
+        else:
+            _release_connection()
+        user_text = stt_future.result()
+        
+        if not user_text:
+            return jsonify({'error': 'Could not process audio'}), 400
+        
+        # A new call is only recorded once its audio has been understood
+        if call is None:
+            call = _create_call(caller_phone, session_id)
+            turn = _begin_turn(call)
+        
+        def generate():
+            started = False
+            with closing(_generate_reply(call, user_text, turn)) as replies:
+                for sentence in replies:
+                    try:
+                        # Raw 24kHz 16-bit mono PCM
+                        for chunk in speech.text_to_speech_stream(sentence, response_format='pcm'):
+                            started = True
+                            yield chunk
+                    except Exception as e:
+                        if not started:
+                            raise
+                        # The response is already under way; skip the sentence rather than end the reply
+                        print(f"Text-to-speech error: {e}")
+        
+        # Return audio response as it is synthesized; the first chunk is produced
+        # up front so a failure before any audio is returned as an error
+        # X-Call-Id lets the client continue the same call on its next turn
+        return Response(
+            stream_with_context(start_stream(generate())),
+            mimetype='audio/pcm',
+            headers={'X-Call-Id': str(turn.call_id)}
+        )
                     
     except Exception as e:
         return jsonify({'error': f'Processing failed: {str(e)}'}), 500
 
+@voice_bp.route('/process-call/jobs', methods=['POST'])
+def submit_call_job():
+    """
+    Queue a voice call turn for background processing
+    
+    Returns 202 with a job ID immediately; the audio reply is collected from /result/<job_id>.
+    """
+    try:
+        # Check if audio file is provided
+        if 'audio' not in request.files:
+            return jsonify({'error': 'No audio file provided'}), 400
+        
+        audio_file = request.files['audio']
+        if audio_file.filename == '':
+            return jsonify({'error': 'No audio file selected'}), 400
+        
+        job_id = call_jobs.submit(
+            _process_call_job,
+            current_app._get_current_object(),
+            audio_file.read(),
+            audio_file.filename,
+            audio_file.mimetype or 'audio/wav',
+            request.form.get('caller_phone', 'Unknown'),
+            request.form.get('call_id'),
+            request.form.get('session_id')
+        )
+        
+        return jsonify({
+            'job_id': job_id,
+            'status': 'pending',
+            'result_url': f'/api/voice/result/{job_id}'
+        }), 202
+        
+    except Exception as e:
+        return jsonify({'error': f'Processing failed: {str(e)}'}), 500
+
+@voice_bp.route('/result/<job_id>', methods=['GET'])
+def get_call_job_result(job_id):
+    """
+    Get the audio reply of a background call job
+    
+    Long-polls for up to ?wait= seconds (default 0, max 30) before reporting the job as pending.
+    A finished job's result can be collected once.
+    """
+    timeout = min(max(request.args.get('wait', 0, type=float), 0), MAX_RESULT_WAIT_SECONDS)
+    
+    future = call_jobs.wait(job_id, timeout=timeout)
+    if future is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    if not future.done():
+        return jsonify({'job_id': job_id, 'status': 'pending'}), 202
+    
+    # Results hold the whole audio reply, so don't keep them once delivered
+    call_jobs.discard(job_id)
+    
+    error = future.exception()
+    if error:
+        # Same status as /process-call for audio that can't be transcribed
+        status = 400 if isinstance(error, AudioNotUnderstoodError) else 500
+        return jsonify({'job_id': job_id, 'status': 'failed', 'error': str(error)}), status
+    
+    result = future.result()
+    return Response(
+        result['audio'],
+        mimetype='audio/pcm',
+        headers={'X-Call-Id': str(result['call_id'])}
+    )
+
+def _process_call_job(app, audio_data, filename, mimetype, caller_phone, call_id, session_id):
+    """Run speech-to-text, dialogue and text-to-speech for a background call job"""
+    with app.app_context():
+        speech = get_speech_service()
+        
+        user_text = speech.speech_to_text(io.BytesIO(audio_data), filename, mimetype)
+        if not user_text:
+            raise AudioNotUnderstoodError('Could not process audio')
+        
+        call = _get_or_create_call(caller_phone, call_id=call_id, session_id=session_id)
+        
+        audio = b''.join(
+            chunk
+            for sentence in _generate_reply(call, user_text)
+            for chunk in speech.text_to_speech_stream(sentence, response_format='pcm')
+        )
+        
+        return {'audio': audio, 'call_id': call.id}
+
+def _get_or_create_call(caller_phone, call_id=None, session_id=None):
+    """Look up a call by ID or session ID, creating it if it doesn't exist"""
+    return _find_call(call_id, session_id) or _create_call(caller_phone, session_id)
+
+def _find_call(call_id=None, session_id=None):
+    """Look up a call by ID or session ID"""
+    if call_id:
+        return db.session.get(Call, call_id)
+    if session_id:
+        return db.session.execute(
+            select(Call).where(Call.session_id == session_id)
+        ).scalar_one_or_none()
+    return None
+
+def _create_call(caller_phone, session_id=None):
+    """
+    Start a new call record
+    
+    The call is committed straight away so its insert doesn't hold a write lock through the turn.
+    """
+    call = Call(
+        session_id=session_id or str(uuid.uuid4()),
+        caller_phone=caller_phone,
+        call_status='active',
+        start_time=datetime.utcnow()
+    )
+    db.session.add(call)
+    db.session.commit()
+    return call
+
+def _release_connection():
+    """
+    End the current read transaction so no pooled connection is held through
+    slow speech or chat calls; the session reconnects on next use
+    """
+    db.session.commit()
+
+def _begin_turn(call):
+    """
+    Read what a turn needs from its call and load the conversation context,
+    then end the read transaction before any slow work starts
+    
+    Returns:
+        CallTurn: The call's ID and appointment state at the start of the turn
+    """
+    turn = CallTurn(call.id, call.primary_intent, call.appointment_booked)
+    get_dialogue_service().prepare_conversation(turn.call_id)
+    _release_connection()
+    return turn
+
+def _generate_reply(call, user_text, turn=None):
+    """
+    Generate the reply to a caller's message, yielding it one sentence at a time
+    
+    Turns of an appointment request get a single structured reply so the
+    appointment can be booked; everything else is streamed sentence by sentence.
+    The turn's changes are saved in one commit, and no transaction is open
+    while the reply is generated or spoken.
+    
+    Args:
+        call (Call): The current call
+        user_text (str): What the caller said
+        turn (CallTurn): State from _begin_turn, if the caller already started the turn
+    """
+    dialogue = get_dialogue_service()
+    if turn is None:
+        turn = _begin_turn(call)
+    
+    if _in_appointment_flow(turn, user_text):
+        yield _generate_structured_reply(call, turn, user_text)
+        return
+    
+    response_parts = []
+    try:
+        for sentence in dialogue.process_message_stream(user_text, turn.call_id):
+            response_parts.append(sentence)
+            yield sentence
+    
+    finally:
+        _save_turn(call, user_text, ' '.join(response_parts))
+
+def _generate_structured_reply(call, turn, user_text):
+    """Generate a structured reply, booking the appointment once confirmed, and save the turn before it is spoken"""
+    dialogue = get_dialogue_service()
+    call_id = turn.call_id
+    
+    result = dialogue.process_message_structured(user_text, call_id, commit=False, hedge=True)
+    reply = result.reply
+    booked = False
+    
+    if result.intent == 'appointment_booking' and not turn.appointment_booked:
+        # Never confirm a booking that wasn't made; ask for what's missing instead
+        reprompt = _book_appointment(call_id, result.appointment)
+        if reprompt:
+            reply = reprompt
+            dialogue.replace_last_reply(call_id, reply)
+        else:
+            booked = True
+    
+    if not _save_turn(call, user_text, reply) and booked:
+        # The appointment was rolled back with the rest of the turn
+        reply = BOOKING_FAILED_REPLY
+        dialogue.replace_last_reply(call_id, reply)
+    
+    return reply
+
+def _in_appointment_flow(turn, user_text):
+    """Whether a turn mentions an appointment or continues one still being scheduled"""
+    if APPOINTMENT_INTENT.search(user_text):
+        return True
+    return turn.primary_intent in APPOINTMENT_FLOW_INTENTS and not turn.appointment_booked
+
+def _book_appointment(call_id, slots):
+    """
+    Create an appointment from structured appointment details
+    
+    Returns:
+        str: None if the appointment was booked, otherwise a reply asking the caller for what's missing
+    """
+    missing = [label for field, label in APPOINTMENT_DETAILS if not slots or not getattr(slots, field)]
+    
+    appointment_date = appointment_time = None
+    if slots and slots.date:
+        try:
+            appointment_date = parse_date(slots.date)
+        except ValueError:
+            missing.append('the date')
+    if slots and slots.time:
+        try:
+            appointment_time = parse_time(slots.time)
+        except ValueError:
+            missing.append('the time')
+    
+    # A date in the past means a relative date was resolved wrongly
+    now = datetime.now()
+    if appointment_date and appointment_date < now.date():
+        missing.append("a date that hasn't already passed")
+    elif appointment_date == now.date() and appointment_time and appointment_time < now.time():
+        missing.append("a time that hasn't already passed")
+    
+    if missing:
+        details = missing[0] if len(missing) == 1 else f"{', '.join(missing[:-1])} and {missing[-1]}"
+        return f"Before I can book that, could you tell me {details}?"
+    
+    booked = get_dialogue_service().create_appointment(call_id, {
+        'customer_name': slots.customer_name,
+        'customer_phone': slots.customer_phone,
+        'customer_email': slots.customer_email,
+        'service_type': slots.service_type,
+        'appointment_date': appointment_date,
+        'appointment_time': appointment_time,
+        'notes': slots.notes
+    }, commit=False)
+    
+    if not booked:
+        return BOOKING_FAILED_REPLY
+    return None
+
+def _save_turn(call, user_text, response_text):
+    """
+    Append a user/assistant exchange to the call's conversation history and
+    commit it with everything else the turn changed
+    
+    Returns:
+        bool: Whether the turn was saved
+    """
+    try:
+        history = call.get_conversation_history()
+        history.append({'role': 'user', 'content': user_text})
+        history.append({'role': 'assistant', 'content': response_text})
+        call.set_conversation_history(history)
+        db.session.commit()
+        return True
+    except Exception as e:
+        print(f"Error saving call turn: {e}")
+        db.session.rollback()
+        return False
+
+@sock.route('/ws/call', bp=voice_bp)
+def stream_call(ws):
+    """
+    Handle a live call over WebSocket
+    
+    The client sends raw 16kHz 16-bit mono PCM as binary frames (or a JSON
+    {"event": "stop"} text frame to end the current utterance). The server
+    sends JSON transcript/response frames and the reply as binary 24kHz PCM.
+    """
+    session_id = request.args.get('session_id') or str(uuid.uuid4())
+    caller_phone = request.args.get('caller_phone', 'Unknown')
+    
+    transcriber = get_speech_service().create_streaming_transcriber()
+    if transcriber is None:
+        ws.send(json.dumps({'type': 'error', 'error': 'Streaming speech-to-text is not available'}))
+        return
+    
+    # No transaction stays open for the life of the socket
+    call = _get_or_create_call(caller_phone, session_id=session_id)
+    _release_connection()
+    
+    ws.send(json.dumps({'type': 'session', 'session_id': session_id}))
+    
+    # Runs until the client disconnects
+    while True:
+        message = ws.receive()
+        
+        if isinstance(message, str):
+            try:
+                control = json.loads(message)
+            except json.JSONDecodeError:
+                continue
+            events = [transcriber.flush()] if control.get('event') == 'stop' else []
+        else:
+            events = transcriber.feed(message)
+        
+        for event in events:
+            if event:
+                _handle_stream_event(ws, transcriber, call, event)
+
+def _handle_stream_event(ws, transcriber, call, event):
+    """Forward a transcript event and answer final transcripts with speech"""
+    ws.send(json.dumps(event))
+    
+    if event['type'] != 'final':
+        return
+    
+    try:
+        if not event['text']:
+            return
+        
+        speech = get_speech_service()
+        for sentence in _generate_reply(call, event['text']):
+            ws.send(json.dumps({'type': 'response', 'text': sentence}))
+            try:
+                for chunk in speech.text_to_speech_stream(sentence, response_format='pcm'):
+                    ws.send(chunk)
+            except Exception as e:
+                print(f"Text-to-speech error: {e}")
+                ws.send(json.dumps({'type': 'error', 'error': 'Text-to-speech failed'}))
+    
+    finally:
+        # Listen for the next utterance
+        transcriber.resume()
+
 @voice_bp.route('/text-to-speech', methods=['POST'])
 def text_to_speech():
     """
@@ -119,15 +502,10 @@ def text_to_speech():
         text = data['text']
         voice = data.get('voice', 'alloy')  # Default voice
         
-        # Convert text to speech
-        audio_data = get_speech_service().text_to_speech(text, voice=voice)
+        # Convert text to speech, streaming chunks as they are synthesized
+        audio_stream = get_speech_service().text_to_speech_stream(text, voice=voice)
         
-        return send_file(
-            io.BytesIO(audio_data),
-            mimetype='audio/wav',
-            as_attachment=True,
-            download_name='speech.wav'
-        )
+        return Response(stream_with_context(audio_stream), mimetype='audio/mpeg')
         
     except Exception as e:
         return jsonify({'error': f'Text-to-speech failed: {str(e)}'}), 500
@@ -146,23 +524,15 @@ def speech_to_text():
         if audio_file.filename == '':
             return jsonify({'error': 'No audio file selected'}), 400
         
-        # Save the uploaded audio file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as temp_file:
-            audio_file.save(temp_file.name)
-            
-            try:
-                # Convert speech to text
-                text = get_speech_service().speech_to_text(temp_file.name)
-                
-                if not text:
-                    return jsonify({'error': 'Could not process audio'}), 400
-                
-                return jsonify({'text': text})
-                
-            finally:
-                # Clean up temporary file
-                if os.path.exists(temp_file.name):
-                    os.unlink(temp_file.name)
+        # Convert speech to text straight from the upload stream
+        text = get_speech_service().speech_to_text(
+            audio_file.stream, audio_file.filename, audio_file.mimetype or 'audio/wav'
+        )
+        
+        if not text:
+            return jsonify({'error': 'Could not process audio'}), 400
+        
+        return jsonify({'text': text})
                     
     except Exception as e:
         return jsonify({'error': f'Speech-to-text failed: {str(e)}'}), 500
@@ -176,8 +546,11 @@ def test_voice_api():
         'message': 'Voice API is working',
         'endpoints': [
             '/api/voice/process-call',
+            '/api/voice/process-call/jobs',
+            '/api/voice/result/<job_id>',
             '/api/voice/text-to-speech',
             '/api/voice/speech-to-text',
+            '/api/voice/ws/call',
             '/api/voice/test'
         ]
     })
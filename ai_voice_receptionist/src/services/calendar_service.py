@@ -4,11 +4,43 @@ Handles calendar integration for appointment scheduling
 """
 
 import json
+import re
 import requests
-from datetime import datetime, timedelta
+from datetime import datetime, date, time, timedelta
 from typing import Dict, List, Optional, Any
 from src.models.call import BusinessConfig
 
+# Shapes accepted by parse_date/parse_time; fromisoformat alone also takes
+# week dates, basic formats and UTC offsets
+DATE_PATTERN = re.compile(r'[0-9]{4}-[0-9]{1,2}-[0-9]{1,2}')
+TIME_PATTERN = re.compile(r'[0-9]{1,2}:[0-9]{2}')
+
+def parse_date(value: str) -> date:
+    """
+    Parse a YYYY-MM-DD date
+    
+    fromisoformat is the fast path; strptime also accepts unpadded months and days.
+    """
+    if not DATE_PATTERN.fullmatch(value):
+        raise ValueError(f"Invalid date: {value!r}")
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+
+def parse_time(value: str) -> time:
+    """
+    Parse an HH:MM time
+    
+    fromisoformat is the fast path; strptime also accepts unpadded hours (e.g. "9:00").
+    """
+    if not TIME_PATTERN.fullmatch(value):
+        raise ValueError(f"Invalid time: {value!r}")
+    try:
+        return time.fromisoformat(value)
+    except ValueError:
+        return datetime.strptime(value, '%H:%M').time()
+
 class CalendarService:
     def __init__(self):
         """Initialize the Calendar Service"""
@@ -45,8 +77,8 @@ class CalendarService:
             available_slots = []
             
             # Generate time slots based on business hours
-            start_date = datetime.strptime(date_start, '%Y-%m-%d')
-            end_date = datetime.strptime(date_end, '%Y-%m-%d')
+            start_date = datetime.combine(parse_date(date_start), time.min)
+            end_date = datetime.combine(parse_date(date_end), time.min)
             
             current_date = start_date
             while current_date <= end_date:
@@ -211,8 +243,8 @@ class CalendarService:
             
             # Prepare event data
             start_datetime = datetime.combine(
-                datetime.strptime(appointment_data['date'], '%Y-%m-%d').date(),
-                datetime.strptime(appointment_data['time'], '%H:%M').time()
+                parse_date(appointment_data['date']),
+                parse_time(appointment_data['time'])
             )
             end_datetime = start_datetime + timedelta(minutes=appointment_data.get('duration', 60))
             
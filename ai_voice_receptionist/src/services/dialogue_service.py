@@ -3,15 +3,199 @@ Dialogue Service
 Handles conversation logic and AI responses for the receptionist
 """
 import os
-from datetime import datetime, timedelta
-from openai import OpenAI
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from datetime import date, datetime, timedelta
+from typing import Literal, Optional
+import tiktoken
+from cachetools import TTLCache
+from pydantic import BaseModel, Field
+from src.services.openai_client import get_openai_client
 from src.models.call import Call, Appointment, BusinessConfig, db
 
+# Sentence boundaries used to hand streamed replies to TTS one sentence at a time
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+')
+SENTENCE_ABBREVIATIONS = {"Dr.", "Mr.", "Mrs.", "Ms.", "St.", "AM.", "PM.", "a.m.", "p.m."}
+MIN_SENTENCE_LENGTH = 10
+
+# Appointment keywords, matched in a single pass per message
+APPOINTMENT_INTENT = re.compile(
+    r"\b(?:appointments?|(?:re)?schedul(?:e|es|ed|ing)|(?:re)?book(?:s|ed|ing)?|meetings?|"
+    r"visit(?:s|ed|ing)?|consultations?|availab(?:le|ility)|see the doctor)\b",
+    re.IGNORECASE
+)
+
+# Business config changes rarely; reuse it across turns for this long
+BUSINESS_CONTEXT_TTL_SECONDS = 60
+
+CHAT_MODEL = "gpt-4o-mini"
+
+# Conversations are dropped after an hour so abandoned calls don't accumulate
+MAX_CONVERSATIONS = 1000
+CONVERSATION_TTL_SECONDS = 3600
+
+# Only the most recent turns within this budget are sent with each request
+MAX_HISTORY_TOKENS = 3000
+
+# tiktoken downloads its vocabulary on first use; after a failed load, token
+# counts are estimated until the next retry
+TOKENIZER_RETRY_SECONDS = 60
+_token_encoding = None
+_token_encoding_retry_at = 0
+_token_encoding_lock = threading.Lock()
+
+# Appointment turns are sent as several identical requests and the first
+# successful reply wins, cutting tail latency where a slow answer hurts most
+HEDGED_REQUESTS = 3
+HEDGE_WORKERS = int(os.getenv('GUNICORN_THREADS', '32'))
+hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix='chat-hedge')
+# Free hedge workers; losing requests can't be cancelled once running, so a
+# turn is only hedged when all of its requests can start immediately
+_hedge_slots = threading.Semaphore(HEDGE_WORKERS)
+
+def split_sentences(buffer):
+    """
+    Split complete sentences off the front of a text buffer
+    
+    Args:
+        buffer (str): Accumulated text
+        
+    Returns:
+        tuple: (list of complete sentences, remaining incomplete text)
+    """
+    sentences = []
+    start = 0
+    
+    for match in SENTENCE_BOUNDARY.finditer(buffer):
+        sentence = buffer[start:match.start()].strip()
+        
+        # Keep accumulating across abbreviations and very short fragments
+        if len(sentence) < MIN_SENTENCE_LENGTH or sentence.split()[-1] in SENTENCE_ABBREVIATIONS:
+            continue
+        
+        sentences.append(sentence)
+        start = match.end()
+    
+    return sentences, buffer[start:]
+
+class AppointmentSlots(BaseModel):
+    """Appointment details collected from the caller so far"""
+    customer_name: Optional[str] = Field(description="Caller's full name")
+    customer_phone: Optional[str] = Field(description="Caller's phone number")
+    customer_email: Optional[str] = Field(description="Caller's email address")
+    service_type: Optional[str] = Field(description="Requested service")
+    date: Optional[str] = Field(description="Appointment date as YYYY-MM-DD, worked out from today's date")
+    time: Optional[str] = Field(description="Appointment time as 24-hour HH:MM")
+    notes: Optional[str] = Field(description="Reason for visit or other notes")
+
+class ReplySchema(BaseModel):
+    """Structured receptionist reply"""
+    reply: str = Field(description="What to say to the caller")
+    intent: Literal[
+        'general_inquiry', 'appointment_scheduling', 'appointment_booking',
+        'take_message', 'transfer', 'goodbye'
+    ] = Field(description="appointment_booking only once the caller has confirmed all appointment details")
+    appointment: Optional[AppointmentSlots] = Field(description="Appointment details, if the caller is scheduling")
+
+def _get_token_encoding():
+    """Get the tokenizer for the chat model, or None while it cannot be loaded"""
+    global _token_encoding, _token_encoding_retry_at
+    if _token_encoding is not None:
+        return _token_encoding
+    
+    with _token_encoding_lock:
+        if _token_encoding is None and time.monotonic() >= _token_encoding_retry_at:
+            try:
+                _token_encoding = tiktoken.encoding_for_model(CHAT_MODEL)
+            except Exception as e:
+                print(f"Error loading tokenizer, estimating token counts: {e}")
+                _token_encoding_retry_at = time.monotonic() + TOKENIZER_RETRY_SECONDS
+        return _token_encoding
+
+def warm_up_tokenizer():
+    """Load the tokenizer ahead of the first chat turn"""
+    _get_token_encoding()
+
+def trim_messages(messages, max_tokens=MAX_HISTORY_TOKENS):
+    """
+    Keep the most recent messages that fit within a token budget
+    
+    Args:
+        messages (list): Conversation messages, oldest first
+        max_tokens (int): Token budget for the returned messages
+        
+    Returns:
+        list: Most recent messages within the budget (always includes the last one)
+    """
+    encoding = _get_token_encoding()
+    total = 0
+    kept = []
+    
+    for message in reversed(messages):
+        if encoding:
+            tokens = len(encoding.encode(message["content"]))
+        else:
+            tokens = len(message["content"]) // 4
+        
+        if kept and total + tokens > max_tokens:
+            break
+        
+        total += tokens
+        kept.append(message)
+    
+    return list(reversed(kept))
+
+def _current_date_message():
+    """
+    System message with today's date, so the model can resolve relative
+    dates like "tomorrow"; kept out of the per-call prompt so it never goes stale
+    """
+    today = date.today()
+    return {"role": "system", "content": f"Today is {today:%A}, {today.isoformat()}."}
+
+@lru_cache(maxsize=1)
+def _build_system_prompt(business_name, business_hours, business_address,
+                         business_phone, business_email, services):
+    """Format the receptionist system prompt for the given business context"""
+    return f"""You are an AI receptionist for {business_name}. You are professional, helpful, and friendly.
+
+Business Information:
+- Business Name: {business_name}
+- Hours: {business_hours}
+- Address: {business_address}
+- Phone: {business_phone}
+- Email: {business_email}
+- Services: {services}
+
+Your responsibilities:
+1. Greet callers professionally
+2. Answer questions about the business
+3. Help schedule appointments
+4. Provide information about services
+5. Take messages when needed
+6. Transfer calls when appropriate
+
+Guidelines:
+- Keep responses conversational and natural
+- Be helpful and patient
+- If you don't know something, say so and offer to take a message
+- For appointments, ask for preferred date/time, contact info, and reason for visit
+- Always confirm important details back to the caller
+
+Respond naturally as if you're speaking on the phone."""
+
 class DialogueService:
     def __init__(self):
         self.client = None
         self._client_initialized = False
-        self.conversation_history = {}
+        self.conversation_history = TTLCache(maxsize=MAX_CONVERSATIONS, ttl=CONVERSATION_TTL_SECONDS)
+        self._history_lock = threading.Lock()
+        self._ctx_cache = None
+        self._ctx_cache_expires = 0
+        self._ctx_cache_version = None
     
     def _ensure_client_initialized(self):
         """Ensure OpenAI client is initialized before use"""
@@ -22,69 +206,65 @@ class DialogueService:
     def _initialize_client(self):
         """Initialize OpenAI client with API key"""
         try:
-            # Try to get API key from business config first
-            api_key = None
-            try:
-                config = BusinessConfig.query.filter_by(key='openai_api_key').first()
-                api_key = config.value if config and config.value else None
-            except:
-                # Database might not be available yet, fall back to environment
-                pass
-            
-            if not api_key:
-                api_key = os.getenv('OPENAI_API_KEY')
+            self.client = get_openai_client()
             
-            if api_key:
-                self.client = OpenAI(api_key=api_key)
-            else:
+            if not self.client:
                 print("Warning: No OpenAI API key found. Dialogue service will not work.")
         except Exception as e:
             print(f"Error initializing OpenAI client: {e}")
     
     def _get_business_context(self):
         """Get business information from config"""
-        context = {}
+        if (self._ctx_cache is not None and time.monotonic() < self._ctx_cache_expires
+                and self._ctx_cache_version == BusinessConfig.version):
+            return self._ctx_cache
+        
+        version = BusinessConfig.version
+        
         config_keys = [
             'business_name', 'business_hours', 'business_address',
             'business_phone', 'business_email', 'services'
         ]
         
-        for key in config_keys:
-            config = BusinessConfig.query.filter_by(key=key).first()
-            context[key] = config.value if config else f"[{key} not configured]"
+        rows = BusinessConfig.query.filter(BusinessConfig.key.in_(config_keys)).all()
+        found = {row.key: row.value for row in rows}
+        context = {key: found.get(key, f"[{key} not configured]") for key in config_keys}
         
+        self._ctx_cache = context
+        self._ctx_cache_expires = time.monotonic() + BUSINESS_CONTEXT_TTL_SECONDS
+        self._ctx_cache_version = version
         return context
     
     def _get_system_prompt(self):
         """Generate system prompt with business context"""
-        context = self._get_business_context()
+        return _build_system_prompt(**self._get_business_context())
+    
+    def _get_conversation(self, call_id):
+        """Get or initialize the conversation state for a call"""
+        with self._history_lock:
+            conversation = self.conversation_history.get(call_id)
+        if conversation is not None:
+            return conversation
         
-        return f"""You are an AI receptionist for {context['business_name']}. You are professional, helpful, and friendly.
-
-Business Information:
-- Business Name: {context['business_name']}
-- Hours: {context['business_hours']}
-- Address: {context['business_address']}
-- Phone: {context['business_phone']}
-- Email: {context['business_email']}
-- Services: {context['services']}
-
-Your responsibilities:
-1. Greet callers professionally
-2. Answer questions about the business
-3. Help schedule appointments
-4. Provide information about services
-5. Take messages when needed
-6. Transfer calls when appropriate
-
-Guidelines:
-- Keep responses conversational and natural
-- Be helpful and patient
-- If you don't know something, say so and offer to take a message
-- For appointments, ask for preferred date/time, contact info, and reason for visit
-- Always confirm important details back to the caller
-
-Respond naturally as if you're speaking on the phone."""
+        # The system prompt is fixed for the lifetime of the call
+        conversation = {
+            "msgs": [],
+            "system": self._get_system_prompt()
+        }
+        with self._history_lock:
+            return self.conversation_history.setdefault(call_id, conversation)
+    
+    def prepare_conversation(self, call_id):
+        """
+        Load business context and build the system prompt for a call ahead of its first message
+        
+        Args:
+            call_id (int): ID of the current call
+        """
+        try:
+            self._get_conversation(call_id)
+        except Exception as e:
+            print(f"Conversation prefetch error: {e}")
     
     def process_message(self, user_message, call_id):
         """
@@ -97,89 +277,245 @@ Respond naturally as if you're speaking on the phone."""
         Returns:
             str: AI response
         """
+        return self.process_message_structured(user_message, call_id).reply
+    
+    def process_message_structured(self, user_message, call_id, commit=True, hedge=None):
+        """
+        Process user message and generate a structured response with intent and appointment details
+        
+        Args:
+            user_message (str): User's message
+            call_id (int): ID of the current call
+            commit (bool): Commit the intent update; pass False when the caller commits the turn
+            hedge (bool): Hedge the request; defaults to whether the message mentions an appointment
+            
+        Returns:
+            ReplySchema: AI response, detected intent and any appointment details
+        """
         try:
             self._ensure_client_initialized()
             
             if not self.client:
-                return "I apologize, but I'm having technical difficulties. Please call back later."
+                return ReplySchema(
+                    reply="I apologize, but I'm having technical difficulties. Please call back later.",
+                    intent='general_inquiry',
+                    appointment=None
+                )
             
             # Get or initialize conversation history for this call
-            if call_id not in self.conversation_history:
-                self.conversation_history[call_id] = []
+            conversation = self._get_conversation(call_id)
             
             # Add user message to history
-            self.conversation_history[call_id].append({
+            conversation["msgs"].append({
                 "role": "user",
                 "content": user_message
             })
             
             # Prepare messages for OpenAI
             messages = [
-                {"role": "system", "content": self._get_system_prompt()}
-            ] + self.conversation_history[call_id]
+                {"role": "system", "content": conversation["system"]},
+                _current_date_message()
+            ] + trim_messages(conversation["msgs"])
             
             # Get AI response
-            response = self.client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=messages,
-                max_tokens=200,
-                temperature=0.7
-            )
+            completion_args = {
+                "model": CHAT_MODEL,
+                "messages": messages,
+                "response_format": ReplySchema,
+                "max_tokens": 300,
+                "temperature": 0.7
+            }
+            parse = self.client.beta.chat.completions.parse
+            if hedge is None:
+                hedge = bool(APPOINTMENT_INTENT.search(user_message))
+            if hedge:
+                response = self._create_hedged_completion(parse, completion_args)
+            else:
+                response = parse(**completion_args)
             
-            ai_response = response.choices[0].message.content
+            result = response.choices[0].message.parsed
+            if result is None:
+                raise Exception(response.choices[0].message.refusal or "No structured response")
             
             # Add AI response to history
-            self.conversation_history[call_id].append({
+            conversation["msgs"].append({
                 "role": "assistant",
-                "content": ai_response
+                "content": result.reply
             })
             
-            # Check if this looks like an appointment request
-            self._check_appointment_intent(user_message, ai_response, call_id)
+            # Record the detected intent on the call
+            call = db.session.get(Call, call_id)
+            if call and result.intent != 'general_inquiry':
+                call.primary_intent = result.intent
+                if commit:
+                    db.session.commit()
             
-            return ai_response
+            return result
             
         except Exception as e:
             print(f"Dialogue processing error: {e}")
-            return "I apologize, but I'm having trouble processing your request right now. Could you please repeat that?"
+            return ReplySchema(
+                reply="I apologize, but I'm having trouble processing your request right now. Could you please repeat that?",
+                intent='general_inquiry',
+                appointment=None
+            )
     
-    def _check_appointment_intent(self, user_message, ai_response, call_id):
+    def replace_last_reply(self, call_id, reply):
         """
-        Check if the conversation indicates appointment scheduling intent
+        Replace the last AI response in a call's history, e.g. when a booking it announced failed
+        
+        Args:
+            call_id (int): ID of the current call
+            reply (str): Response the caller actually heard
         """
-        appointment_keywords = [
-            'appointment', 'schedule', 'book', 'meeting', 'visit',
-            'see the doctor', 'consultation', 'available'
-        ]
+        msgs = self._get_conversation(call_id)["msgs"]
+        if msgs and msgs[-1]["role"] == "assistant":
+            msgs[-1]["content"] = reply
+    
+    def _create_hedged_completion(self, create, completion_args):
+        """
+        Send identical chat requests concurrently and return the first successful response
         
-        if any(keyword in user_message.lower() for keyword in appointment_keywords):
-            # Update call status to indicate appointment interest
-            call = Call.query.get(call_id)
-            if call:
-                call.intent = 'appointment_scheduling'
-                db.session.commit()
+        Falls back to a single request when the hedge pool is busy, so a turn
+        never waits behind other calls' requests.
+        
+        Args:
+            create (callable): Chat completion method to call
+            completion_args (dict): Arguments for the completion call
+            
+        Returns:
+            ChatCompletion: Fastest successful response
+        """
+        acquired = 0
+        while acquired < HEDGED_REQUESTS and _hedge_slots.acquire(blocking=False):
+            acquired += 1
+        
+        if acquired < HEDGED_REQUESTS:
+            for _ in range(acquired):
+                _hedge_slots.release()
+            return create(**completion_args)
+        
+        def hedged_create():
+            try:
+                return create(**completion_args)
+            finally:
+                _hedge_slots.release()
+        
+        futures = [hedge_executor.submit(hedged_create) for _ in range(HEDGED_REQUESTS)]
+        
+        error = None
+        for future in as_completed(futures):
+            try:
+                response = future.result()
+            except Exception as e:
+                error = e
+                continue
+            
+            # Requests already in flight finish in the background; queued ones are dropped
+            for other in futures:
+                if other.cancel():
+                    _hedge_slots.release()
+            return response
+        
+        raise error
     
-    def create_appointment(self, call_id, appointment_data):
+    def process_message_stream(self, user_message, call_id):
+        """
+        Process user message and stream the response sentence by sentence
+        
+        Args:
+            user_message (str): User's message
+            call_id (int): ID of the current call
+            
+        Yields:
+            str: Complete sentences of the AI response as they are generated
+        """
+        ai_response = ''
+        
+        try:
+            self._ensure_client_initialized()
+            
+            if not self.client:
+                yield "I apologize, but I'm having technical difficulties. Please call back later."
+                return
+            
+            # Get or initialize conversation history for this call
+            conversation = self._get_conversation(call_id)
+            
+            # Add user message to history
+            conversation["msgs"].append({
+                "role": "user",
+                "content": user_message
+            })
+            
+            # Prepare messages for OpenAI
+            messages = [
+                {"role": "system", "content": conversation["system"]},
+                _current_date_message()
+            ] + trim_messages(conversation["msgs"])
+            
+            # Stream AI response tokens
+            stream = self.client.chat.completions.create(
+                model=CHAT_MODEL,
+                messages=messages,
+                max_tokens=200,
+                temperature=0.7,
+                stream=True
+            )
+            
+            buffer = ''
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                
+                token = chunk.choices[0].delta.content
+                if not token:
+                    continue
+                
+                ai_response += token
+                buffer += token
+                
+                sentences, buffer = split_sentences(buffer)
+                for sentence in sentences:
+                    yield sentence
+            
+            # Flush whatever is left once the stream ends
+            if buffer.strip():
+                yield buffer.strip()
+            
+            # Add AI response to history
+            conversation["msgs"].append({
+                "role": "assistant",
+                "content": ai_response
+            })
+            
+        except Exception as e:
+            print(f"Dialogue streaming error: {e}")
+            if not ai_response:
+                yield "I apologize, but I'm having trouble processing your request right now. Could you please repeat that?"
+    
+    def create_appointment(self, call_id, appointment_data, commit=True):
         """
         Create an appointment from call data
         
         Args:
             call_id (int): ID of the call
             appointment_data (dict): Appointment details
+            commit (bool): Commit the appointment; pass False when the caller commits the turn
             
         Returns:
             bool: Success status
         """
         try:
-            call = Call.query.get(call_id)
+            call = db.session.get(Call, call_id)
             if not call:
                 return False
             
             appointment = Appointment(
                 call_id=call_id,
-                patient_name=appointment_data.get('patient_name'),
-                patient_phone=call.caller_phone,
-                patient_email=appointment_data.get('patient_email'),
+                customer_name=appointment_data.get('customer_name'),
+                customer_phone=appointment_data.get('customer_phone') or call.caller_phone,
+                customer_email=appointment_data.get('customer_email'),
                 appointment_date=appointment_data.get('appointment_date'),
                 appointment_time=appointment_data.get('appointment_time'),
                 service_type=appointment_data.get('service_type'),
@@ -188,14 +524,17 @@ Respond naturally as if you're speaking on the phone."""
             )
             
             db.session.add(appointment)
-            call.intent = 'appointment_scheduled'
-            db.session.commit()
+            call.primary_intent = 'appointment_scheduled'
+            call.appointment_booked = True
+            if commit:
+                db.session.commit()
             
             return True
             
         except Exception as e:
             print(f"Appointment creation error: {e}")
-            db.session.rollback()
+            if commit:
+                db.session.rollback()
             return False
     
     def end_conversation(self, call_id):
@@ -205,11 +544,11 @@ Respond naturally as if you're speaking on the phone."""
         Args:
             call_id (int): ID of the call
         """
-        if call_id in self.conversation_history:
-            del self.conversation_history[call_id]
+        with self._history_lock:
+            self.conversation_history.pop(call_id, None)
         
         # Update call status
-        call = Call.query.get(call_id)
+        call = db.session.get(Call, call_id)
         if call:
             call.status = 'completed'
             call.end_time = datetime.utcnow()
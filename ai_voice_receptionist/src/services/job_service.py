@@ -0,0 +1,69 @@
+"""
+Job Service
+Runs long voice-processing work in the background and tracks results by job ID
+"""
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from cachetools import TTLCache
+
+class JobStore:
+    """
+    In-process background job runner
+    
+    Jobs run on a thread pool; finished and pending jobs are kept for ttl_seconds
+    so clients can collect the result, and should be discarded once collected.
+    """
+    
+    def __init__(self, max_workers=16, max_jobs=1000, ttl_seconds=600):
+        """
+        Args:
+            max_workers (int): Jobs processed concurrently
+            max_jobs (int): Maximum jobs tracked at once
+            ttl_seconds (int): How long a job's result is kept
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._jobs = TTLCache(maxsize=max_jobs, ttl=ttl_seconds)
+        self._lock = threading.Lock()
+    
+    def submit(self, fn, *args, **kwargs):
+        """
+        Start a job in the background
+        
+        Returns:
+            str: Job ID
+        """
+        job_id = uuid.uuid4().hex
+        future = self._executor.submit(fn, *args, **kwargs)
+        with self._lock:
+            self._jobs[job_id] = future
+        return job_id
+    
+    def wait(self, job_id, timeout=0):
+        """
+        Wait up to timeout seconds for a job to finish
+        
+        Args:
+            job_id (str): Job ID
+            timeout (float): Seconds to wait
+        
+        Returns:
+            Future: The job's future (check done()), or None if the job is unknown or expired
+        """
+        with self._lock:
+            future = self._jobs.get(job_id)
+        if future is None:
+            return None
+        
+        wait([future], timeout=timeout)
+        return future
+    
+    def discard(self, job_id):
+        """
+        Stop tracking a job, e.g. once its result has been delivered
+        
+        Args:
+            job_id (str): Job ID
+        """
+        with self._lock:
+            self._jobs.pop(job_id, None)
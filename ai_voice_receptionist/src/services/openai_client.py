@@ -0,0 +1,61 @@
+"""
+OpenAI Client
+Shared OpenAI client and HTTP connection pool used by all services
+"""
+import os
+import threading
+import httpx
+from openai import OpenAI
+from src.models.call import BusinessConfig
+
+# One keep-alive pool per process so requests reuse warm TCP/TLS connections
+http_client = httpx.Client(
+    http2=True,
+    timeout=60.0,
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=100)
+)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_openai_api_key():
+    """
+    Get the OpenAI API key from business config, falling back to the environment
+    
+    Returns:
+        str: API key or None if not configured
+    """
+    api_key = None
+    try:
+        config = BusinessConfig.query.filter_by(key='openai_api_key').first()
+        api_key = config.value if config and config.value else None
+    except:
+        # Database might not be available yet, fall back to environment
+        pass
+    
+    return api_key or os.getenv('OPENAI_API_KEY')
+
+def get_openai_client():
+    """
+    Get the shared OpenAI client for the configured API key
+    
+    Returns:
+        OpenAI: Client using the shared connection pool, or None if no API key is configured
+    """
+    api_key = get_openai_api_key()
+    if not api_key:
+        return None
+    
+    with _clients_lock:
+        if api_key not in _clients:
+            _clients[api_key] = OpenAI(api_key=api_key, http_client=http_client)
+        return _clients[api_key]
+
+def warm_up_openai():
+    """Open a connection to the OpenAI API ahead of the first request"""
+    try:
+        client = get_openai_client()
+        if client:
+            client.models.list()
+    except Exception as e:
+        print(f"OpenAI warm-up failed: {e}")
@@ -4,15 +4,65 @@ Handles speech-to-text and text-to-speech operations
 """
 import os
 import io
+import hashlib
+import subprocess
+import threading
 import openai
-from openai import OpenAI
-from src.models.call import BusinessConfig
+from cachetools import LRUCache
+from src.services.openai_client import get_openai_client
+from src.services.streaming_stt_service import StreamingTranscriber
+
+try:
+    from faster_whisper import WhisperModel
+except ImportError:
+    # Local speech-to-text is optional; OpenAI Whisper is used without it
+    WhisperModel = None
+
+TTS_MODEL = "tts-1"
+
+# Uploads larger than this are re-encoded to 24 kbit/s Opus before going to Whisper
+OPUS_THRESHOLD_BYTES = 200 * 1024
+
+def start_stream(chunks):
+    """
+    Read the first chunk of a generator now, so an error raised before any
+    output reaches the caller instead of silently ending a started response
+    
+    Args:
+        chunks (generator): Chunk generator
+        
+    Returns:
+        generator: All of the chunks, starting with the first
+    """
+    first = next(chunks, None)
+    return _resume_stream(first, chunks)
+
+def _resume_stream(first, chunks):
+    """Yield an already-read first chunk, then the rest of the generator"""
+    if first is None:
+        return
+    yield first
+    yield from chunks
 
 class SpeechService:
-    def __init__(self):
+    def __init__(self, use_local=None):
         # Get OpenAI API key from business config or environment
         self.client = None
         self._client_initialized = False
+        
+        # Local faster-whisper transcription, falling back to OpenAI Whisper
+        if use_local is None:
+            use_local = os.getenv('LOCAL_STT', 'false').lower() == 'true'
+        self.use_local = use_local
+        self._local_model = None
+        self._local_model_failed = False
+        self._local_model_lock = threading.Lock()
+        
+        # Synthesized audio and transcripts are cached in memory (bounded);
+        # they can contain caller details, so they are never written to disk
+        self._tts_cache = LRUCache(maxsize=256)
+        self._stt_cache = LRUCache(maxsize=256)
+        self._cache_lock = threading.Lock()
     
     def _ensure_client_initialized(self):
         """Ensure OpenAI client is initialized before use"""
@@ -23,52 +73,144 @@ class SpeechService:
     def _initialize_client(self):
         """Initialize OpenAI client with API key"""
         try:
-            # Try to get API key from business config first
-            api_key = None
-            try:
-                config = BusinessConfig.query.filter_by(key='openai_api_key').first()
-                api_key = config.value if config and config.value else None
-            except:
-                # Database might not be available yet, fall back to environment
-                pass
+            self.client = get_openai_client()
             
-            if not api_key:
-                api_key = os.getenv('OPENAI_API_KEY')
-            
-            if api_key:
-                self.client = OpenAI(api_key=api_key)
-            else:
+            if not self.client:
                 print("Warning: No OpenAI API key found. Speech services will not work.")
         except Exception as e:
             print(f"Error initializing OpenAI client: {e}")
     
-    def speech_to_text(self, audio_file_path):
+    def speech_to_text(self, audio_stream, filename="audio.wav", mimetype="audio/wav"):
         """
         Convert speech to text using OpenAI Whisper
         
         Args:
-            audio_file_path (str): Path to the audio file
+            audio_stream (file-like): Readable binary audio stream (e.g. an upload's stream)
+            filename (str): Original file name, used by Whisper to detect the format
+            mimetype (str): MIME type of the audio
             
         Returns:
             str: Transcribed text or None if failed
         """
         try:
+            audio_data = audio_stream.read()
+            key = hashlib.sha256(audio_data).hexdigest()
+            with self._cache_lock:
+                cached = self._stt_cache.get(key)
+            if cached is not None:
+                return cached
+            
+            if self.use_local:
+                text = self._local_speech_to_text(audio_data)
+                if text is not None:
+                    with self._cache_lock:
+                        self._stt_cache[key] = text
+                    return text
+            
             self._ensure_client_initialized()
             
             if not self.client:
                 raise Exception("OpenAI client not initialized")
             
-            with open(audio_file_path, 'rb') as audio_file:
-                transcript = self.client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file
-                )
-                return transcript.text
+            # Shrink large uploads; fall back to the original audio if encoding fails
+            if len(audio_data) > OPUS_THRESHOLD_BYTES:
+                encoded = self._encode_opus(audio_data)
+                if encoded:
+                    filename, audio_data, mimetype = "audio.ogg", encoded, "audio/ogg"
+            
+            transcript = self.client.audio.transcriptions.create(
+                model="whisper-1",
+                file=(filename, audio_data, mimetype)
+            )
+            
+            with self._cache_lock:
+                self._stt_cache[key] = transcript.text
+            return transcript.text
                 
         except Exception as e:
             print(f"Speech-to-text error: {e}")
             return None
     
+    def _encode_opus(self, audio_data):
+        """
+        Re-encode audio to Ogg/Opus with ffmpeg
+        
+        Args:
+            audio_data (bytes): Encoded audio in any format ffmpeg reads
+            
+        Returns:
+            bytes: Ogg/Opus audio or None if encoding failed
+        """
+        try:
+            result = subprocess.run(
+                ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+                 "-c:a", "libopus", "-b:a", "24k", "-f", "ogg", "pipe:1"],
+                input=audio_data,
+                capture_output=True,
+                timeout=30
+            )
+        except (OSError, subprocess.TimeoutExpired) as e:
+            print(f"Opus encoding error: {e}")
+            return None
+        
+        if result.returncode != 0 or not result.stdout:
+            print(f"Opus encoding error: {result.stderr.decode(errors='replace').strip()}")
+            return None
+        
+        return result.stdout
+    
+    def _get_local_model(self):
+        """Load the local faster-whisper model on first use"""
+        with self._local_model_lock:
+            if self._local_model is None and not self._local_model_failed:
+                if WhisperModel is None:
+                    print("Warning: faster-whisper is not installed. Using OpenAI Whisper.")
+                    self._local_model_failed = True
+                else:
+                    try:
+                        self._local_model = WhisperModel(
+                            os.getenv('LOCAL_STT_MODEL', 'small.en'),
+                            device=os.getenv('LOCAL_STT_DEVICE', 'cpu'),
+                            compute_type=os.getenv('LOCAL_STT_COMPUTE_TYPE', 'int8')
+                        )
+                    except Exception as e:
+                        print(f"Error loading local Whisper model: {e}")
+                        self._local_model_failed = True
+            return self._local_model
+    
+    def _local_speech_to_text(self, audio_data):
+        """
+        Convert speech to text with the local faster-whisper model
+        
+        Args:
+            audio_data (bytes): Encoded audio
+            
+        Returns:
+            str: Transcribed text or None if local transcription is unavailable
+        """
+        model = self._get_local_model()
+        if model is None:
+            return None
+        
+        try:
+            segments, _ = model.transcribe(io.BytesIO(audio_data), beam_size=1, vad_filter=True)
+            return " ".join(segment.text.strip() for segment in segments).strip()
+        except Exception as e:
+            print(f"Local speech-to-text error: {e}")
+            return None
+    
+    def create_streaming_transcriber(self):
+        """
+        Create a stateful transcriber for a live audio stream
+        
+        Returns:
+            StreamingTranscriber: Transcriber backed by the local model, or None if unavailable
+        """
+        model = self._get_local_model()
+        if model is None:
+            return None
+        return StreamingTranscriber(model)
+    
     def text_to_speech(self, text, voice="alloy"):
         """
         Convert text to speech using OpenAI TTS
@@ -81,23 +223,110 @@ class SpeechService:
             bytes: Audio data or None if failed
         """
         try:
-            self._ensure_client_initialized()
-            
-            if not self.client:
-                raise Exception("OpenAI client not initialized")
+            key = self._tts_cache_key(text, voice, "mp3")
+            cached = self._get_cached_speech(key)
+            if cached is not None:
+                return cached
             
-            response = self.client.audio.speech.create(
-                model="tts-1",
-                voice=voice,
-                input=text
-            )
+            data = self._synthesize(text, voice)
+            if data:
+                self._cache_speech(key, data)
             
-            return response.content
+            return data
             
         except Exception as e:
             print(f"Text-to-speech error: {e}")
             return None
     
+    def _synthesize(self, text, voice):
+        """Synthesize speech with OpenAI TTS, bypassing the cache"""
+        self._ensure_client_initialized()
+        
+        if not self.client:
+            raise Exception("OpenAI client not initialized")
+        
+        response = self.client.audio.speech.create(
+            model=TTS_MODEL,
+            voice=voice,
+            input=text
+        )
+        
+        return response.content
+    
+    def _tts_cache_key(self, text, voice, response_format):
+        """Build the cache key for a synthesized phrase"""
+        return hashlib.sha256(f"{text}|{voice}|{TTS_MODEL}|{response_format}".encode()).hexdigest()
+    
+    def _get_cached_speech(self, key):
+        """Look up synthesized audio in the cache"""
+        with self._cache_lock:
+            return self._tts_cache.get(key)
+    
+    def _cache_speech(self, key, data):
+        """Store synthesized audio in the cache"""
+        with self._cache_lock:
+            self._tts_cache[key] = data
+    
+    def text_to_speech_stream(self, text, voice="alloy", response_format="mp3", chunk_size=4096):
+        """
+        Convert text to speech using OpenAI TTS, yielding audio as it is synthesized
+        
+        Args:
+            text (str): Text to convert to speech
+            voice (str): Voice to use (alloy, echo, fable, onyx, nova, shimmer)
+            response_format (str): Audio format (mp3, opus, aac, flac, wav, pcm)
+            chunk_size (int): Size of the yielded chunks in bytes
+            
+        Returns:
+            generator: Yields audio bytes chunks
+        
+        Raises:
+            Exception: If synthesis fails before any audio is produced
+        """
+        key = self._tts_cache_key(text, voice, response_format)
+        cached = self._get_cached_speech(key)
+        if cached is not None:
+            return self._iter_cached_speech(cached, chunk_size)
+        
+        # Validate eagerly so callers can report a failure before streaming starts
+        self._ensure_client_initialized()
+        
+        if not self.client:
+            raise Exception("OpenAI client not initialized")
+        
+        # Send the request and read the first chunk now, so an upstream error
+        # is raised here rather than ending an already-started response
+        return start_stream(self._stream_speech(text, voice, response_format, chunk_size, key))
+    
+    def _iter_cached_speech(self, data, chunk_size):
+        """Yield cached audio in chunks"""
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+    
+    def _stream_speech(self, text, voice, response_format, chunk_size, key):
+        """Yield audio chunks from a streaming TTS response, caching it once complete"""
+        chunks = []
+        try:
+            with self.client.audio.speech.with_streaming_response.create(
+                model=TTS_MODEL,
+                voice=voice,
+                input=text,
+                response_format=response_format
+            ) as response:
+                for chunk in response.iter_bytes(chunk_size):
+                    chunks.append(chunk)
+                    yield chunk
+                
+        except Exception as e:
+            if not chunks:
+                raise
+            # Audio has already been sent, so the stream can only end early
+            print(f"Text-to-speech streaming error: {e}")
+            return
+        
+        if chunks:
+            self._cache_speech(key, b''.join(chunks))
+    
     def get_available_voices(self):
         """
         Get list of available TTS voices
@@ -0,0 +1,214 @@
+"""
+Streaming Speech-to-Text Service
+Transcribes live call audio incrementally with voice activity detection
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import torch
+    from silero_vad import load_silero_vad
+except ImportError:
+    # Silero VAD is optional; a simple energy threshold is used without it
+    load_silero_vad = None
+
+class StreamingTranscriber:
+    """
+    Stateful transcriber for one audio stream
+    
+    Audio is fed as raw 16kHz 16-bit mono PCM. Each 32ms frame is run through
+    VAD; while the caller is speaking the buffered audio is re-transcribed
+    every step and words that agree across two consecutive hypotheses are
+    confirmed (LocalAgreement-2). Confirmed words are dropped from the buffer
+    so each pass only transcribes the unconfirmed tail. A stretch of silence
+    ends the utterance.
+    """
+    
+    IDLE = 'idle'
+    LISTENING = 'listening'
+    PROCESSING = 'processing'
+    
+    SAMPLE_RATE = 16000
+    FRAME_SAMPLES = 512  # 32ms at 16kHz
+    
+    def __init__(self, model, silence_ms=700, step_seconds=1.0, max_buffer_seconds=30,
+                 speech_threshold=0.5, energy_threshold=0.01):
+        """
+        Args:
+            model: faster-whisper WhisperModel used for transcription
+            silence_ms (int): Silence that ends an utterance
+            step_seconds (float): Interval between partial transcriptions
+            max_buffer_seconds (int): Longest unconfirmed audio before the utterance is flushed
+            speech_threshold (float): Silero VAD speech probability threshold
+            energy_threshold (float): RMS threshold used when Silero VAD is unavailable
+        """
+        self.model = model
+        self.vad = load_silero_vad() if load_silero_vad else None
+        self.state = self.IDLE
+        
+        self.silence_samples = int(self.SAMPLE_RATE * silence_ms / 1000)
+        self.step_samples = int(self.SAMPLE_RATE * step_seconds)
+        self.max_buffer_samples = int(self.SAMPLE_RATE * max_buffer_seconds)
+        self.speech_threshold = speech_threshold
+        self.energy_threshold = energy_threshold
+        
+        self._pending = bytearray()
+        # Final text of the previous utterance, used as the transcription prompt
+        self.last_confirmed_text = ''
+        self._reset_utterance()
+    
+    def _reset_utterance(self):
+        """Clear buffered audio and hypotheses for the current utterance"""
+        self._frames = []
+        self._buffered_samples = 0
+        self._trailing_silence = 0
+        self._samples_since_step = 0
+        self._previous_words = []
+        self.confirmed_words = []
+    
+    def feed(self, pcm):
+        """
+        Feed raw PCM audio
+        
+        Args:
+            pcm (bytes): 16kHz 16-bit little-endian mono PCM
+        
+        Returns:
+            list: Transcript events ({'type': 'partial'|'final', 'text': ...})
+        """
+        events = []
+        if self.state == self.PROCESSING:
+            return events
+        
+        self._pending.extend(pcm)
+        frame_bytes = self.FRAME_SAMPLES * 2
+        
+        while len(self._pending) >= frame_bytes:
+            frame = np.frombuffer(bytes(self._pending[:frame_bytes]), dtype=np.int16)
+            del self._pending[:frame_bytes]
+            
+            event = self._process_frame(frame.astype(np.float32) / 32768.0)
+            if event:
+                events.append(event)
+                if event['type'] == 'final':
+                    break
+        
+        return events
+    
+    def flush(self):
+        """
+        End the current utterance immediately
+        
+        Returns:
+            dict: Final transcript event or None if nothing was being spoken
+        """
+        if self.state != self.LISTENING:
+            return None
+        return self._finalize()
+    
+    def resume(self):
+        """Start listening for the next utterance after a final transcript was handled"""
+        self._pending.clear()
+        self._reset_utterance()
+        self.state = self.IDLE
+        if self.vad is not None:
+            self.vad.reset_states()
+    
+    def _process_frame(self, frame):
+        """Advance the state machine by one 32ms frame"""
+        is_speech = self._is_speech(frame)
+        
+        if self.state == self.IDLE:
+            if not is_speech:
+                return None
+            self.state = self.LISTENING
+        
+        self._frames.append(frame)
+        self._buffered_samples += len(frame)
+        self._samples_since_step += len(frame)
+        self._trailing_silence = 0 if is_speech else self._trailing_silence + len(frame)
+        
+        if self._trailing_silence >= self.silence_samples or self._buffered_samples >= self.max_buffer_samples:
+            return self._finalize()
+        
+        if self._samples_since_step >= self.step_samples:
+            self._samples_since_step = 0
+            return self._partial()
+        
+        return None
+    
+    def _is_speech(self, frame):
+        """Run VAD on a single frame"""
+        if self.vad is not None:
+            probability = self.vad(torch.from_numpy(frame), self.SAMPLE_RATE).item()
+            return probability >= self.speech_threshold
+        
+        return float(np.sqrt(np.mean(frame ** 2))) >= self.energy_threshold
+    
+    def _transcribe(self):
+        """
+        Transcribe the buffered audio
+        
+        Returns:
+            list: (word, end sample) pairs, with end samples relative to the buffer
+        """
+        if not self._buffered_samples:
+            return []
+        
+        # Earlier speech is passed as the prompt so trimmed context is not lost
+        prompt = " ".join([self.last_confirmed_text] + self.confirmed_words).strip()
+        segments, _ = self.model.transcribe(
+            np.concatenate(self._frames),
+            beam_size=1,
+            word_timestamps=True,
+            initial_prompt=prompt or None
+        )
+        return [
+            (word.word.strip(), int(word.end * self.SAMPLE_RATE))
+            for segment in segments
+            for word in segment.words or []
+        ]
+    
+    def _trim(self, samples):
+        """Drop audio from the front of the buffer"""
+        audio = np.concatenate(self._frames)[samples:]
+        self._frames = [audio]
+        self._buffered_samples = len(audio)
+    
+    def _partial(self):
+        """Emit a partial hypothesis with its confirmed prefix"""
+        words = self._transcribe()
+        
+        # LocalAgreement-2: the common prefix of the last two hypotheses is stable
+        agreed = 0
+        for previous, (current, _) in zip(self._previous_words, words):
+            if previous != current:
+                break
+            agreed += 1
+        
+        if agreed:
+            self.confirmed_words.extend(word for word, _ in words[:agreed])
+            self._trim(words[agreed - 1][1])
+            words = words[agreed:]
+        
+        self._previous_words = [word for word, _ in words]
+        
+        return {
+            'type': 'partial',
+            'confirmed': " ".join(self.confirmed_words),
+            'text': " ".join(self.confirmed_words + self._previous_words)
+        }
+    
+    def _finalize(self):
+        """Transcribe the rest of the utterance and hold until resume() is called"""
+        self.state = self.PROCESSING
+        words = [word for word, _ in self._transcribe()]
+        text = " ".join(self.confirmed_words + words).strip()
+        
+        if text:
+            self.last_confirmed_text = text
+        self._reset_utterance()
+        
+        return {'type': 'final', 'text': text}
@@ -0,0 +1,451 @@
+"""
+Route Test Suite for AI Voice Receptionist
+Tests voice and phone API routes against an in-memory database
+"""
+
+import unittest
+import io
+import os
+import sys
+import threading
+from datetime import date, datetime, time, timedelta
+from unittest.mock import MagicMock, patch
+
+# Add the project directory to the path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import Flask
+from sqlalchemy import event
+from src.models.user import db
+from src.models.call import Call, Appointment
+from src.routes import voice_api
+from src.routes.voice_api import voice_bp
+from src.routes.phone_api import phone_bp
+from src.services.dialogue_service import DialogueService, ReplySchema, AppointmentSlots
+from src.services.speech_service import SpeechService
+from src.services.job_service import JobStore
+
+def create_test_app():
+    """Create an app with the API blueprints and an in-memory database"""
+    app = Flask(__name__)
+    app.config['TESTING'] = True
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    app.register_blueprint(voice_bp, url_prefix='/api/voice')
+    app.register_blueprint(phone_bp, url_prefix='/api/phone')
+    return app
+
+app = create_test_app()
+
+class RouteTestCase(unittest.TestCase):
+    """Base test case with a fresh database per test"""
+    
+    def setUp(self):
+        """Set up test fixtures"""
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+    
+    def tearDown(self):
+        """Clean up after tests"""
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+    
+    def add_call(self, **fields):
+        """Save a call record"""
+        call = Call(session_id=fields.pop('session_id', 'test-session'), caller_phone='+15551234567', **fields)
+        db.session.add(call)
+        db.session.commit()
+        return call
+
+class CallListTestCase(RouteTestCase):
+    """Test cases for the paginated call history"""
+    
+    def setUp(self):
+        """Save calls with known start times and statuses"""
+        super().setUp()
+        for index in range(5):
+            self.add_call(session_id=f'session-{index}', start_time=datetime(2025, 8, 1, 9, index),
+                          call_status='completed' if index % 2 == 0 else 'in_progress')
+    
+    def test_calls_are_paginated(self):
+        """Test the page, total and page count of the call list"""
+        response = self.client.get('/api/phone/calls?page=2&per_page=2')
+        data = response.get_json()
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['total'], 5)
+        self.assertEqual(data['pages'], 3)
+        self.assertEqual(data['current_page'], 2)
+        self.assertEqual([call['session_id'] for call in data['calls']], ['session-2', 'session-1'])
+    
+    def test_calls_are_filtered_by_status(self):
+        """Test the status filter applies to the calls and the total"""
+        response = self.client.get('/api/phone/calls?status=in_progress')
+        data = response.get_json()
+        
+        self.assertEqual(data['total'], 2)
+        self.assertEqual(data['pages'], 1)
+        self.assertEqual([call['session_id'] for call in data['calls']], ['session-3', 'session-1'])
+    
+    def test_call_rows_match_call_dict(self):
+        """Test each listed call matches Call.to_dict without the conversation history"""
+        response = self.client.get('/api/phone/calls?per_page=1')
+        call = response.get_json()['calls'][0]
+        
+        expected = Call.query.filter_by(session_id='session-4').one().to_dict()
+        del expected['conversation_history']
+        self.assertEqual(call, expected)
+
+class CallJobResultTestCase(RouteTestCase):
+    """Test cases for collecting background process-call results"""
+    
+    def setUp(self):
+        """Use a job store private to the test"""
+        super().setUp()
+        self.jobs = JobStore(max_workers=2)
+        patcher = patch.object(voice_api, 'call_jobs', self.jobs)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def test_unknown_job_is_not_found(self):
+        """Test an unknown job ID returns 404"""
+        response = self.client.get('/api/voice/result/missing')
+        
+        self.assertEqual(response.status_code, 404)
+    
+    def test_pending_job_is_accepted(self):
+        """Test a running job returns 202 once the wait expires"""
+        release = threading.Event()
+        job_id = self.jobs.submit(release.wait, 5)
+        
+        response = self.client.get(f'/api/voice/result/{job_id}?wait=0.05')
+        release.set()
+        
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.get_json(), {'job_id': job_id, 'status': 'pending'})
+    
+    def test_finished_job_returns_audio(self):
+        """Test a finished job returns its audio and call ID"""
+        job_id = self.jobs.submit(lambda: {'audio': b'\x00\x01', 'call_id': 7})
+        
+        response = self.client.get(f'/api/voice/result/{job_id}?wait=5')
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'audio/pcm')
+        self.assertEqual(response.data, b'\x00\x01')
+        self.assertEqual(response.headers['X-Call-Id'], '7')
+    
+    def test_finished_job_is_collected_once(self):
+        """Test a delivered result is no longer kept"""
+        job_id = self.jobs.submit(lambda: {'audio': b'\x00\x01', 'call_id': 7})
+        
+        self.assertEqual(self.client.get(f'/api/voice/result/{job_id}?wait=5').status_code, 200)
+        self.assertEqual(self.client.get(f'/api/voice/result/{job_id}').status_code, 404)
+    
+    def test_failed_job_reports_error(self):
+        """Test a failed job returns 500 with its error"""
+        def fail():
+            raise Exception('Calendar unavailable')
+        
+        job_id = self.jobs.submit(fail)
+        
+        response = self.client.get(f'/api/voice/result/{job_id}?wait=5')
+        
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.get_json()['error'], 'Calendar unavailable')
+    
+    def test_untranscribed_audio_is_a_client_error(self):
+        """Test a job whose audio couldn't be transcribed returns 400 like /process-call"""
+        def fail():
+            raise voice_api.AudioNotUnderstoodError('Could not process audio')
+        
+        job_id = self.jobs.submit(fail)
+        
+        response = self.client.get(f'/api/voice/result/{job_id}?wait=5')
+        
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['error'], 'Could not process audio')
+
+class DialogueRouteTestCase(RouteTestCase):
+    """Base test case with the dialogue service mocked out"""
+    
+    def setUp(self):
+        """Use a dialogue service without an OpenAI client"""
+        super().setUp()
+        self.dialogue = DialogueService()
+        self.dialogue._client_initialized = True
+        patcher = patch.object(voice_api, 'dialogue_service', self.dialogue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def booking_reply(self, **slots):
+        """Build a structured reply confirming an appointment"""
+        details = {
+            'customer_name': 'John Smith', 'customer_phone': None, 'customer_email': None,
+            'service_type': 'Consultation', 'date': (date.today() + timedelta(days=7)).isoformat(),
+            'time': '9:00', 'notes': None
+        }
+        details.update(slots)
+        return ReplySchema(
+            reply="You're booked for Tuesday at 9.",
+            intent='appointment_booking',
+            appointment=AppointmentSlots(**details)
+        )
+
+class SpeechRouteTestCase(DialogueRouteTestCase):
+    """Test cases for the audio routes with a mocked OpenAI client"""
+    
+    def setUp(self):
+        """Use a speech service with a mocked OpenAI client and a private job store"""
+        super().setUp()
+        self.speech = SpeechService(use_local=False)
+        self.speech.client = MagicMock()
+        self.speech._client_initialized = True
+        self.speech.client.audio.transcriptions.create.return_value = MagicMock(text='What are your hours?')
+        self.tts = self.speech.client.audio.speech.with_streaming_response.create
+        self.tts.return_value.__enter__.return_value.iter_bytes.return_value = [b'ab', b'cd']
+        for name, value in [('speech_service', self.speech), ('call_jobs', JobStore(max_workers=1))]:
+            patcher = patch.object(voice_api, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+    
+    def run_call_job(self):
+        """Send a call turn to /process-call/jobs and collect its result"""
+        with patch.object(self.dialogue, 'process_message_stream',
+                          return_value=iter(['We open at 9.', 'We close at 6.'])):
+            submitted = self.client.post('/api/voice/process-call/jobs',
+                                         data={'audio': (io.BytesIO(b'audio'), 'audio.wav')})
+            self.assertEqual(submitted.status_code, 202)
+            return self.client.get(f"{submitted.get_json()['result_url']}?wait=5")
+    
+    def post_call_audio(self, **fields):
+        """Send a call turn to /process-call"""
+        with patch.object(self.dialogue, 'process_message_stream',
+                          return_value=iter(['We open at 9.', 'We close at 6.'])):
+            response = self.client.post('/api/voice/process-call',
+                                        data={'audio': (io.BytesIO(b'audio'), 'audio.wav'), **fields})
+            # Read the streamed reply while the dialogue is still patched
+            response.get_data()
+        return response
+    
+    def test_text_to_speech_failure_is_an_error(self):
+        """Test a failed synthesis returns 500 rather than an empty audio stream"""
+        self.tts.side_effect = Exception('Invalid voice')
+        
+        response = self.client.post('/api/voice/text-to-speech', json={'text': 'Hello', 'voice': 'bogus'})
+        
+        self.assertEqual(response.status_code, 500)
+        self.assertIn('Invalid voice', response.get_json()['error'])
+    
+    def test_process_call_reports_failed_synthesis(self):
+        """Test a reply whose first sentence can't be synthesized returns 500"""
+        self.tts.side_effect = Exception('Invalid voice')
+        
+        response = self.post_call_audio()
+        
+        self.assertEqual(response.status_code, 500)
+        self.assertIn('Invalid voice', response.get_json()['error'])
+    
+    def test_failed_transcription_records_no_call(self):
+        """Test audio that can't be transcribed returns 400 without leaving a call behind"""
+        self.speech.client.audio.transcriptions.create.side_effect = Exception('Invalid audio')
+        
+        response = self.post_call_audio()
+        
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Call.query.count(), 0)
+    
+    def test_process_call_identifies_the_call(self):
+        """Test the reply carries the call ID and later turns continue the same call"""
+        first = self.post_call_audio(session_id='caller-session')
+        call = Call.query.one()
+        self.assertEqual(first.headers['X-Call-Id'], str(call.id))
+        self.assertEqual(call.session_id, 'caller-session')
+        
+        self.assertEqual(self.post_call_audio(session_id='caller-session').headers['X-Call-Id'], str(call.id))
+        self.assertEqual(self.post_call_audio(call_id=str(call.id)).headers['X-Call-Id'], str(call.id))
+        self.assertEqual(Call.query.count(), 1)
+        self.assertEqual(len(db.session.get(Call, call.id).get_conversation_history()), 6)
+    
+    def test_call_job_returns_the_reply(self):
+        """Test a background call turn is transcribed, answered and synthesized"""
+        response = self.run_call_job()
+        
+        call = Call.query.one()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'audio/pcm')
+        self.assertEqual(response.data, b'abcdabcd')
+        self.assertEqual(response.headers['X-Call-Id'], str(call.id))
+        self.assertEqual(call.get_conversation_history()[0], {'role': 'user', 'content': 'What are your hours?'})
+    
+    def test_call_job_with_untranscribed_audio(self):
+        """Test a background turn with audio that can't be transcribed returns 400 and records no call"""
+        self.speech.client.audio.transcriptions.create.side_effect = Exception('Invalid audio')
+        
+        response = self.run_call_job()
+        
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['error'], 'Could not process audio')
+        self.assertEqual(Call.query.count(), 0)
+    
+    def test_process_call_streams_each_sentence(self):
+        """Test every sentence of the reply is synthesized into the response"""
+        response = self.post_call_audio()
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'audio/pcm')
+        self.assertEqual(response.data, b'abcdabcd')
+
+class AppointmentFlowTestCase(DialogueRouteTestCase):
+    """Test cases for routing and booking appointment turns"""
+    
+    def test_confirmation_turn_books_appointment(self):
+        """Test a confirmation without appointment keywords stays on the booking path"""
+        call = self.add_call(primary_intent='appointment_scheduling')
+        
+        with patch.object(self.dialogue, 'process_message_structured', return_value=self.booking_reply()), \
+                patch.object(self.dialogue, 'process_message_stream') as stream:
+            reply = list(voice_api._generate_reply(call, "Yes, that's correct"))
+        
+        self.assertEqual(reply, ["You're booked for Tuesday at 9."])
+        stream.assert_not_called()
+        
+        appointment = Appointment.query.one()
+        self.assertEqual(appointment.appointment_time, time(9, 0))
+        self.assertEqual(appointment.customer_phone, '+15551234567')
+        self.assertTrue(db.session.get(Call, call.id).appointment_booked)
+    
+    def test_missing_details_are_requested(self):
+        """Test a booking with missing details asks for them instead of confirming"""
+        call = self.add_call(primary_intent='appointment_scheduling')
+        
+        with patch.object(self.dialogue, 'process_message_structured',
+                          return_value=self.booking_reply(date=None, time='3pm')), \
+                patch.object(self.dialogue, 'replace_last_reply') as replace_last_reply:
+            reply = list(voice_api._generate_reply(call, 'John Smith, next Tuesday at 3pm'))
+        
+        self.assertEqual(reply, ['Before I can book that, could you tell me the date and the time?'])
+        replace_last_reply.assert_called_once_with(call.id, reply[0])
+        self.assertEqual(Appointment.query.count(), 0)
+        self.assertFalse(db.session.get(Call, call.id).appointment_booked)
+    
+    def test_past_date_is_not_booked(self):
+        """Test a date that has already passed is queried instead of booked"""
+        call = self.add_call(primary_intent='appointment_scheduling')
+        yesterday = (date.today() - timedelta(days=1)).isoformat()
+        
+        with patch.object(self.dialogue, 'process_message_structured',
+                          return_value=self.booking_reply(date=yesterday)), \
+                patch.object(self.dialogue, 'replace_last_reply'):
+            reply = list(voice_api._generate_reply(call, "Yes, that's correct"))
+        
+        self.assertEqual(reply, ["Before I can book that, could you tell me a date that hasn't already passed?"])
+        self.assertEqual(Appointment.query.count(), 0)
+    
+    def test_general_turn_is_streamed(self):
+        """Test turns outside an appointment request use the streaming path"""
+        call = self.add_call()
+        
+        with patch.object(self.dialogue, 'process_message_structured') as structured, \
+                patch.object(self.dialogue, 'process_message_stream',
+                             return_value=iter(['We open at 9.', 'We close at 6.'])):
+            reply = list(voice_api._generate_reply(call, 'What are your hours?'))
+        
+        self.assertEqual(reply, ['We open at 9.', 'We close at 6.'])
+        structured.assert_not_called()
+        self.assertEqual(db.session.get(Call, call.id).get_conversation_history(), [
+            {'role': 'user', 'content': 'What are your hours?'},
+            {'role': 'assistant', 'content': 'We open at 9. We close at 6.'}
+        ])
+
+class TurnTransactionTestCase(DialogueRouteTestCase):
+    """Test cases for how a call turn uses the database"""
+    
+    def setUp(self):
+        """Count flushes and commits made by the session"""
+        super().setUp()
+        self.flushes = []
+        self.commits = []
+        session = db.session()
+        listeners = [('after_flush', lambda session, context: self.flushes.append(True)),
+                     ('after_commit', lambda session: self.commits.append(True))]
+        for name, listener in listeners:
+            event.listen(session, name, listener)
+            self.addCleanup(event.remove, session, name, listener)
+    
+    def fake_stream(self, user_text, call_id):
+        """Yield a reply, recording whether a transaction was open while generating it"""
+        for sentence in ['We open at 9.', 'We close at 6.']:
+            self.open_transactions.append(db.session().in_transaction())
+            yield sentence
+    
+    def test_no_transaction_is_held_while_the_reply_streams(self):
+        """Test the connection is released before the reply is generated and the turn saved after"""
+        call = self.add_call()
+        self.open_transactions = []
+        self.flushes.clear()
+        
+        with patch.object(self.dialogue, 'process_message_stream', side_effect=self.fake_stream):
+            list(voice_api._generate_reply(call, 'What are your hours?'))
+        
+        self.assertEqual(self.open_transactions, [False, False])
+        self.assertEqual(len(self.flushes), 1)
+        self.assertFalse(db.session().in_transaction())
+    
+    def test_call_is_not_reloaded_before_the_turn_is_saved(self):
+        """Test a started turn reads the call's state without selecting its row again"""
+        call = voice_api._find_call(call_id=self.add_call().id)
+        statements = []
+        
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        
+        event.listen(db.engine, 'before_cursor_execute', record)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute', record)
+        
+        turn = voice_api._begin_turn(call)
+        with patch.object(self.dialogue, 'process_message_stream', side_effect=self.fake_stream):
+            self.open_transactions = []
+            list(voice_api._generate_reply(call, 'What are your hours?', turn))
+        
+        # Selected once, to append the exchange to the conversation history
+        self.assertEqual(len([statement for statement in statements if statement.startswith('SELECT calls.')]), 1)
+    
+    def test_booking_turn_is_saved_in_one_flush(self):
+        """Test the intent, appointment and exchange are written together before the reply is spoken"""
+        call = self.add_call(primary_intent='appointment_scheduling')
+        open_transactions = []
+        
+        def structured(user_text, call_id, **kwargs):
+            open_transactions.append(db.session().in_transaction())
+            return self.booking_reply()
+        
+        self.flushes.clear()
+        with patch.object(self.dialogue, 'process_message_structured', side_effect=structured):
+            replies = voice_api._generate_reply(call, "Yes, that's correct")
+            next(replies)
+            
+            # Saved before the reply is handed to text-to-speech
+            self.assertEqual(len(self.flushes), 1)
+            self.assertFalse(db.session().in_transaction())
+            list(replies)
+        
+        self.assertEqual(open_transactions, [False])
+        self.assertEqual(Appointment.query.count(), 1)
+        self.assertEqual(len(db.session.get(Call, call.id).get_conversation_history()), 2)
+    
+    def test_new_call_is_committed_immediately(self):
+        """Test a new call is not left in an open write transaction"""
+        self.commits.clear()
+        
+        call = voice_api._get_or_create_call('+15551234567', session_id='new-session')
+        
+        self.assertEqual(len(self.commits), 1)
+        self.assertFalse(db.session().in_transaction())
+        self.assertIsNotNone(call.id)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,308 @@
+"""
+Service Test Suite for AI Voice Receptionist
+Tests service logic that runs without the API server or database
+"""
+
+import unittest
+import io
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+# Add the project directory to the path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from datetime import date, time as time_of_day
+from src.services import dialogue_service
+from src.services.calendar_service import parse_date, parse_time
+from src.services.dialogue_service import APPOINTMENT_INTENT, split_sentences, trim_messages
+from src.services.speech_service import SpeechService
+from src.services.job_service import JobStore
+from src.services.streaming_stt_service import StreamingTranscriber, np
+
+class SentenceSplitTestCase(unittest.TestCase):
+    """Test cases for streamed reply sentence splitting"""
+    
+    def test_split_complete_sentences(self):
+        """Test complete sentences are split off and the remainder kept"""
+        sentences, remainder = split_sentences("Thanks for calling today. How can I help you? I can")
+        
+        self.assertEqual(sentences, ['Thanks for calling today.', 'How can I help you?'])
+        self.assertEqual(remainder, 'I can')
+    
+    def test_split_skips_abbreviations_and_short_fragments(self):
+        """Test abbreviations and short fragments do not end a sentence"""
+        sentences, remainder = split_sentences("Hi. Dr. Smith is available at 9 a.m. tomorrow. ")
+        
+        self.assertEqual(sentences, ['Hi. Dr. Smith is available at 9 a.m. tomorrow.'])
+        self.assertEqual(remainder, '')
+
+class AppointmentIntentTestCase(unittest.TestCase):
+    """Test cases for appointment keyword matching"""
+    
+    def test_appointment_keywords_match(self):
+        """Test appointment phrases are detected regardless of case"""
+        for message in ['I want to BOOK an appointment', 'Can I schedule a visit?',
+                        'Is Dr. Lee available Monday?', 'I need to see the doctor']:
+            self.assertIsNotNone(APPOINTMENT_INTENT.search(message), message)
+    
+    def test_appointment_inflections_match(self):
+        """Test plural and re- forms of the keywords are detected"""
+        for message in ['I need to reschedule', 'Can I rebook for Friday?', 'How many visits do I get?',
+                        'Do you offer consultations?', "What's your availability next week?"]:
+            self.assertIsNotNone(APPOINTMENT_INTENT.search(message), message)
+    
+    def test_appointment_keywords_require_whole_words(self):
+        """Test keywords inside other words are not detected"""
+        for message in ['What are your hours?', 'I read your bookkeeping guide', 'Revisiting my bill']:
+            self.assertIsNone(APPOINTMENT_INTENT.search(message), message)
+
+class CalendarParsingTestCase(unittest.TestCase):
+    """Test cases for appointment date and time parsing"""
+    
+    def test_parse_iso_and_unpadded_values(self):
+        """Test padded and unpadded dates and times are accepted"""
+        self.assertEqual(parse_date('2025-08-01'), date(2025, 8, 1))
+        self.assertEqual(parse_date('2025-8-1'), date(2025, 8, 1))
+        self.assertEqual(parse_time('14:30'), time_of_day(14, 30))
+        self.assertEqual(parse_time('9:00'), time_of_day(9, 0))
+    
+    def test_parse_rejects_invalid_values(self):
+        """Test malformed values raise ValueError"""
+        for parse, value in [(parse_date, 'next Tuesday'), (parse_time, '3pm')]:
+            with self.assertRaises(ValueError):
+                parse(value)
+    
+    def test_parse_rejects_other_iso_formats(self):
+        """Test ISO forms beyond YYYY-MM-DD and HH:MM are rejected"""
+        values = [(parse_date, '2025-W31-5'), (parse_date, '20250801'), (parse_date, '2025-08-01T09:00'),
+                  (parse_time, '09:00Z'), (parse_time, '09:00+02:00'), (parse_time, '09:00:30'), (parse_time, '0900')]
+        for parse, value in values:
+            with self.assertRaises(ValueError):
+                parse(value)
+
+class TrimMessagesTestCase(unittest.TestCase):
+    """Test cases for token-window trimming of conversation history"""
+    
+    def setUp(self):
+        """Estimate token counts as characters / 4"""
+        patcher = patch.object(dialogue_service, '_get_token_encoding', return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def test_keeps_most_recent_messages_within_budget(self):
+        """Test older messages are dropped once the budget is reached"""
+        messages = [{'role': 'user', 'content': f'{i}' * 40} for i in range(5)]
+        
+        kept = trim_messages(messages, max_tokens=25)
+        
+        self.assertEqual(kept, messages[-2:])
+    
+    def test_always_keeps_last_message(self):
+        """Test the latest message is kept even when it exceeds the budget"""
+        messages = [{'role': 'user', 'content': 'hi'}, {'role': 'user', 'content': 'x' * 400}]
+        
+        self.assertEqual(trim_messages(messages, max_tokens=10), messages[-1:])
+
+class TokenEncodingTestCase(unittest.TestCase):
+    """Test cases for loading the tokenizer"""
+    
+    def setUp(self):
+        """Start without a loaded tokenizer"""
+        for name, value in [('_token_encoding', None), ('_token_encoding_retry_at', 0),
+                            ('TOKENIZER_RETRY_SECONDS', 0)]:
+            patcher = patch.object(dialogue_service, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+    
+    def test_failed_load_is_retried(self):
+        """Test a failed tokenizer download is not cached for the life of the process"""
+        encoding = MagicMock()
+        with patch.object(dialogue_service.tiktoken, 'encoding_for_model',
+                          side_effect=[OSError('offline'), encoding]) as load:
+            self.assertIsNone(dialogue_service._get_token_encoding())
+            self.assertIs(dialogue_service._get_token_encoding(), encoding)
+            self.assertIs(dialogue_service._get_token_encoding(), encoding)
+        
+        self.assertEqual(load.call_count, 2)
+
+class HedgedCompletionTestCase(unittest.TestCase):
+    """Test cases for hedged chat completions"""
+    
+    def test_first_successful_response_wins(self):
+        """Test identical requests are sent and a failed one is ignored"""
+        responses = iter([RuntimeError('timeout'), 'reply', 'reply'])
+        lock = threading.Lock()
+        
+        def create(**kwargs):
+            with lock:
+                response = next(responses)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        
+        create = MagicMock(side_effect=create)
+        result = dialogue_service.DialogueService()._create_hedged_completion(create, {'model': 'test'})
+        
+        self.assertEqual(result, 'reply')
+        self.assertEqual(create.call_count, dialogue_service.HEDGED_REQUESTS)
+    
+    def test_busy_pool_sends_single_request(self):
+        """Test a turn is not hedged when the pool can't start every request"""
+        create = MagicMock(return_value='reply')
+        slots = threading.Semaphore(dialogue_service.HEDGED_REQUESTS - 1)
+        
+        with patch.object(dialogue_service, '_hedge_slots', slots):
+            result = dialogue_service.DialogueService()._create_hedged_completion(create, {'model': 'test'})
+        
+        self.assertEqual(result, 'reply')
+        create.assert_called_once_with(model='test')
+        # Slots taken while checking are given back
+        self.assertTrue(all(slots.acquire(blocking=False) for _ in range(dialogue_service.HEDGED_REQUESTS - 1)))
+
+class DateContextTestCase(unittest.TestCase):
+    """Test cases for telling the model today's date"""
+    
+    def test_each_request_includes_todays_date(self):
+        """Test today's date is sent as its own system message after the call's prompt"""
+        dialogue = dialogue_service.DialogueService()
+        dialogue.client = MagicMock()
+        dialogue.client.chat.completions.create.return_value = iter([])
+        dialogue._client_initialized = True
+        
+        with patch.object(dialogue, '_get_system_prompt', return_value='You are a receptionist.'):
+            list(dialogue.process_message_stream('Can I come in tomorrow?', call_id=1))
+        
+        messages = dialogue.client.chat.completions.create.call_args.kwargs['messages']
+        today = date.today()
+        self.assertEqual(messages[0], {'role': 'system', 'content': 'You are a receptionist.'})
+        self.assertEqual(messages[1], {'role': 'system', 'content': f"Today is {today:%A}, {today.isoformat()}."})
+
+class SpeechCacheTestCase(unittest.TestCase):
+    """Test cases for the speech-to-text and text-to-speech caches"""
+    
+    def setUp(self):
+        """Set up a speech service with a mocked OpenAI client"""
+        self.speech = SpeechService(use_local=False)
+        self.speech.client = MagicMock()
+        self.speech._client_initialized = True
+        
+        self.speech.client.audio.transcriptions.create.return_value = MagicMock(text='Hello there')
+        response = self.speech.client.audio.speech.with_streaming_response.create.return_value.__enter__.return_value
+        response.iter_bytes.return_value = [b'ab', b'cd']
+    
+    def test_repeated_audio_is_transcribed_once(self):
+        """Test identical audio is served from the transcript cache"""
+        first = self.speech.speech_to_text(io.BytesIO(b'audio'))
+        second = self.speech.speech_to_text(io.BytesIO(b'audio'))
+        
+        self.assertEqual(first, 'Hello there')
+        self.assertEqual(second, 'Hello there')
+        self.assertEqual(self.speech.client.audio.transcriptions.create.call_count, 1)
+    
+    def test_repeated_phrase_is_synthesized_once(self):
+        """Test a repeated phrase is served from the memory cache"""
+        first = b''.join(self.speech.text_to_speech_stream('Thanks for calling.', response_format='pcm'))
+        second = b''.join(self.speech.text_to_speech_stream('Thanks for calling.', response_format='pcm'))
+        
+        self.assertEqual(first, b'abcd')
+        self.assertEqual(second, b'abcd')
+        self.assertEqual(self.speech.client.audio.speech.with_streaming_response.create.call_count, 1)
+    
+    def test_failed_synthesis_raises_before_streaming(self):
+        """Test an upstream error is raised when the stream is opened, not while iterating"""
+        self.speech.client.audio.speech.with_streaming_response.create.side_effect = Exception('Invalid voice')
+        
+        with self.assertRaises(Exception):
+            self.speech.text_to_speech_stream('Thanks for calling.', voice='bogus')
+    
+    def test_error_after_first_chunk_ends_stream(self):
+        """Test an error once audio has been sent ends the stream without caching it"""
+        def iter_bytes(chunk_size):
+            yield b'ab'
+            raise Exception('Connection reset')
+        
+        response = self.speech.client.audio.speech.with_streaming_response.create.return_value.__enter__.return_value
+        response.iter_bytes.side_effect = iter_bytes
+        
+        self.assertEqual(b''.join(self.speech.text_to_speech_stream('Thanks for calling.')), b'ab')
+        self.assertEqual(len(self.speech._tts_cache), 0)
+
+class JobStoreTestCase(unittest.TestCase):
+    """Test cases for background job tracking"""
+    
+    def test_wait_returns_finished_job(self):
+        """Test a job's result is available through its ID"""
+        jobs = JobStore(max_workers=1)
+        job_id = jobs.submit(lambda x: x * 2, 21)
+        
+        future = jobs.wait(job_id, timeout=5)
+        
+        self.assertTrue(future.done())
+        self.assertEqual(future.result(), 42)
+    
+    def test_wait_times_out_on_pending_job(self):
+        """Test waiting on a running job returns it unfinished after the timeout"""
+        release = threading.Event()
+        jobs = JobStore(max_workers=1)
+        job_id = jobs.submit(release.wait, 5)
+        
+        future = jobs.wait(job_id, timeout=0.05)
+        
+        self.assertFalse(future.done())
+        release.set()
+    
+    def test_discarded_job_is_unknown(self):
+        """Test a discarded job's result is no longer kept"""
+        jobs = JobStore(max_workers=1)
+        job_id = jobs.submit(lambda: None)
+        
+        jobs.discard(job_id)
+        
+        self.assertIsNone(jobs.wait(job_id))
+    
+    def test_unknown_and_expired_jobs(self):
+        """Test unknown and expired job IDs return None"""
+        jobs = JobStore(max_workers=1, ttl_seconds=0.05)
+        job_id = jobs.submit(lambda: None)
+        
+        self.assertIsNone(jobs.wait('missing'))
+        time.sleep(0.1)
+        self.assertIsNone(jobs.wait(job_id))
+
+class FakeWhisperModel:
+    """Whisper stand-in that always hears the same two words"""
+    
+    def __init__(self):
+        self.audio_lengths = []
+    
+    def transcribe(self, audio, **kwargs):
+        self.audio_lengths.append(len(audio))
+        words = [
+            SimpleNamespace(word=' Hello', start=0.0, end=0.4),
+            SimpleNamespace(word=' there', start=0.4, end=0.8)
+        ]
+        return [SimpleNamespace(text=' Hello there', words=words)], None
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class StreamingTranscriberTestCase(unittest.TestCase):
+    """Test cases for incremental streaming transcription"""
+    
+    def test_confirmed_words_are_trimmed_from_the_buffer(self):
+        """Test audio for confirmed words is not transcribed again"""
+        model = FakeWhisperModel()
+        transcriber = StreamingTranscriber(model)
+        step = StreamingTranscriber.FRAME_SAMPLES * 32
+        speech = (np.ones(step, dtype=np.int16) * 10000).tobytes()
+        
+        events = [event for _ in range(3) for event in transcriber.feed(speech)]
+        
+        self.assertEqual([event['confirmed'] for event in events], ['', 'Hello there', 'Hello there'])
+        # The second pass confirms both words, dropping their 0.8s of audio
+        self.assertEqual(model.audio_lengths, [step, 2 * step, 3 * step - 12800])
+
+if __name__ == '__main__':
+    unittest.main()